@@ -0,0 +1,325 @@
+"""
+Configuration shared by proxy.py and healthcheck.py.
+
+All environment variables are validated once and compiled into an immutable plan with one entry per port. proxy.py
+caches the plan in the temp dir on startup, so healthcheck can load it instead of parsing the environment again.
+"""
+import json
+import os
+from collections import namedtuple
+
+# environment variables with their defaults, None means required
+VARIABLES = {
+    "TARGET": None,
+    "PORT": "80 443",
+    "MODE": "tcp",
+    "ENGINE": "socat",
+    "EVENT_LOOP": "asyncio",
+    "PRE_RESOLVE": "0",
+    "NAMESERVERS": "208.67.222.222 8.8.8.8 208.67.220.220 8.8.4.4",
+    "VERBOSE": "0",
+    "MAX_CONNECTIONS": "100",
+    "UDP_ANSWERS": "1",
+    "CONNECT_TIMEOUT_MS": "10000",
+    "CIRCUIT_BREAKER_FAILURES": "5",
+    "CIRCUIT_BREAKER_WINDOW_MS": "10000",
+    "CIRCUIT_BREAKER_RESET_MS": "5000",
+    "CIRCUIT_BREAKER_PROBES": "1",
+    "HTTP_HEALTHCHECK": "0",
+    "HTTP_HEALTHCHECK_URL": "http://localhost/",
+    "HTTP_HEALTHCHECK_TIMEOUT_MS": "2000",
+    "SMTP_HEALTHCHECK": "0",
+    "SMTP_HEALTHCHECK_URL": "smtp://localhost/",
+    "SMTP_HEALTHCHECK_COMMAND": "HELP",
+    "SMTP_HEALTHCHECK_TIMEOUT_MS": "2000",
+    "HEALTHCHECK_HISTORY_SIZE": "10",
+    "HEALTHCHECK_FAILURES": "1",
+    "HEALTHCHECK_SUCCESSES": "1",
+    "HEALTHCHECK_DEGRADED_MS": "0",
+    "HEALTHCHECK_EWMA_ALPHA": "0.3",
+    "PASSIVE_HEALTHCHECK_IDLE_MS": "0",
+}
+
+PLAN_FILE = "proxy_plan.json"
+
+# healthcheck probes connect from this loopback address, so the relay can tell them apart from real clients, which
+# may connect from 127.0.0.1 too when the proxy runs as a sidecar
+PROBE_ADDRESS = "127.0.0.2"
+
+
+class PortPlan(
+    namedtuple(
+        "PortPlan",
+        [
+            "port",
+            "listen_address",
+            "backlog",
+            "reuse_address",
+            "upstream_port",
+            "max_connections",
+            "connect_timeout_ms",
+            "http_check_url",
+            "smtp_check_url",
+        ],
+    )
+):
+    """
+    Everything needed to proxy one port to the target of the Plan, the check urls are only set for the port the
+    healthcheck requests
+    """
+
+    __slots__ = ()
+
+
+class Plan(
+    namedtuple(
+        "Plan",
+        [
+            "target",
+            "mode",
+            "engine",
+            "event_loop",
+            "pre_resolve",
+            "nameservers",
+            "verbose",
+            "udp_answers",
+            "circuit_breaker_failures",
+            "circuit_breaker_window_ms",
+            "circuit_breaker_reset_ms",
+            "circuit_breaker_probes",
+            "http_healthcheck",
+            "http_healthcheck_timeout_ms",
+            "smtp_healthcheck",
+            "smtp_healthcheck_command",
+            "smtp_healthcheck_timeout_ms",
+            "healthcheck_history_size",
+            "healthcheck_failures",
+            "healthcheck_successes",
+            "healthcheck_degraded_ms",
+            "healthcheck_ewma_alpha",
+            "passive_healthcheck_idle_ms",
+            "fingerprint",
+            "ports",
+        ],
+    )
+):
+    """
+    The validated configuration with one PortPlan per port
+    """
+
+    __slots__ = ()
+
+    def check(self, name):
+        """
+        Find the port requested by the http or smtp healthcheck
+        :return: the url and the PortPlan of its port
+        """
+        for port in self.ports:
+            url = getattr(port, f"{name}_check_url")
+            if url:
+                return url, port
+        raise ValueError(f"No port for the {name} healthcheck")
+
+
+def fingerprint(environ):
+    """
+    :return: a hash of the configuration in environ, to detect a cached plan being outdated
+    """
+    import hashlib
+
+    values = json.dumps([environ.get(name) for name in VARIABLES])
+    return hashlib.sha256(values.encode("utf-8")).hexdigest()
+
+
+def _integer(environ, name, minimum=0):
+    value = environ.get(name) or VARIABLES[name]
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+    if number < minimum:
+        raise ValueError(f"{name} must be at least {minimum}, got {number}")
+    return number
+
+
+def _flag(environ, name):
+    value = environ.get(name) or VARIABLES[name]
+    if value not in ("0", "1"):
+        raise ValueError(f"{name} must be 0 or 1, got {value!r}")
+    return value == "1"
+
+
+def _choice(environ, name, choices):
+    value = environ.get(name) or VARIABLES[name]
+    if value not in choices:
+        raise ValueError(f"{name} must be one of {', '.join(choices)}, got {value!r}")
+    return value
+
+
+def _check_url(url, scheme, default_port, ports, enabled):
+    """
+    Make sure url requests one of the proxied ports
+    :return: the url and its port
+    """
+    import re
+
+    match = re.search(f"{scheme}://[^:]*(?::([^/]+))?", url)
+    if not match:
+        if enabled:
+            raise ValueError(f"Invalid healthcheck url: {url}")
+        return None, None
+    port = match[1]
+    if not port:
+        port = default_port
+        if port not in ports:
+            port = ports[0]
+            url = re.sub(f"({scheme}://[^/]+)", r"\1:{}".format(port), url)
+    return url, port
+
+
+def compile_plan(environ=None):
+    """
+    Validate the configuration in environ and compile it into a plan
+    :return: the Plan
+    """
+    import socket
+
+    environ = os.environ if environ is None else environ
+    target = environ.get("TARGET")
+    if not target:
+        raise ValueError("TARGET is required")
+    ports = (environ.get("PORT") or VARIABLES["PORT"]).split()
+    if not ports:
+        raise ValueError("PORT is required")
+    for port in ports:
+        if not port.isdigit() or not 0 < int(port) < 65536:
+            raise ValueError(f"PORT must be a list of ports, got {port!r}")
+    if len(set(ports)) != len(ports):
+        raise ValueError("PORT contains duplicated ports")
+    mode = _choice(environ, "MODE", ("tcp", "udp"))
+    engine = _choice(environ, "ENGINE", ("socat", "asyncio"))
+    pre_resolve = _flag(environ, "PRE_RESOLVE")
+    nameservers = tuple(
+        (environ.get("NAMESERVERS") or VARIABLES["NAMESERVERS"]).split()
+    )
+    alpha = environ.get("HEALTHCHECK_EWMA_ALPHA") or VARIABLES["HEALTHCHECK_EWMA_ALPHA"]
+    try:
+        alpha = float(alpha)
+    except ValueError:
+        alpha = 0
+    if not 0 < alpha <= 1:
+        raise ValueError("HEALTHCHECK_EWMA_ALPHA must be in (0, 1]")
+    history_size = _integer(environ, "HEALTHCHECK_HISTORY_SIZE", 1)
+    failures = _integer(environ, "HEALTHCHECK_FAILURES", 1)
+    successes = _integer(environ, "HEALTHCHECK_SUCCESSES", 1)
+    if history_size < max(failures, successes):
+        raise ValueError(
+            "HEALTHCHECK_HISTORY_SIZE must hold HEALTHCHECK_FAILURES and HEALTHCHECK_SUCCESSES results"
+        )
+    http_healthcheck = _flag(environ, "HTTP_HEALTHCHECK")
+    smtp_healthcheck = _flag(environ, "SMTP_HEALTHCHECK")
+    http_url = (
+        environ.get("HTTP_HEALTHCHECK_URL") or VARIABLES["HTTP_HEALTHCHECK_URL"]
+    ).replace("$TARGET", target)
+    http_url, http_port = _check_url(
+        http_url,
+        "https?",
+        "80" if http_url.startswith("http://") else "443",
+        ports,
+        http_healthcheck,
+    )
+    smtp_url = (
+        environ.get("SMTP_HEALTHCHECK_URL") or VARIABLES["SMTP_HEALTHCHECK_URL"]
+    ).replace("$TARGET", target)
+    smtp_url, smtp_port = _check_url(smtp_url, "smtp", "25", ports, smtp_healthcheck)
+    for name, enabled, port in (
+        ("HTTP", http_healthcheck, http_port),
+        ("SMTP", smtp_healthcheck, smtp_port),
+    ):
+        if enabled and port not in ports:
+            raise ValueError(f"{name}_HEALTHCHECK_URL requests port {port} not in PORT")
+    if mode != "tcp" and engine == "asyncio":
+        raise ValueError("ENGINE asyncio supports MODE tcp only")
+    if pre_resolve and not nameservers:
+        raise ValueError("NAMESERVERS are required to PRE_RESOLVE")
+    max_connections = _integer(environ, "MAX_CONNECTIONS", 1)
+    connect_timeout_ms = _integer(environ, "CONNECT_TIMEOUT_MS", 1)
+    return Plan(
+        target=target,
+        mode=mode,
+        engine=engine,
+        event_loop=_choice(environ, "EVENT_LOOP", ("asyncio", "uvloop")),
+        pre_resolve=pre_resolve,
+        nameservers=nameservers,
+        verbose=_flag(environ, "VERBOSE"),
+        udp_answers=_flag(environ, "UDP_ANSWERS"),
+        circuit_breaker_failures=_integer(environ, "CIRCUIT_BREAKER_FAILURES"),
+        circuit_breaker_window_ms=_integer(environ, "CIRCUIT_BREAKER_WINDOW_MS"),
+        circuit_breaker_reset_ms=_integer(environ, "CIRCUIT_BREAKER_RESET_MS"),
+        circuit_breaker_probes=_integer(environ, "CIRCUIT_BREAKER_PROBES", 1),
+        http_healthcheck=http_healthcheck,
+        http_healthcheck_timeout_ms=_integer(environ, "HTTP_HEALTHCHECK_TIMEOUT_MS"),
+        smtp_healthcheck=smtp_healthcheck,
+        smtp_healthcheck_command=environ.get("SMTP_HEALTHCHECK_COMMAND")
+        or VARIABLES["SMTP_HEALTHCHECK_COMMAND"],
+        smtp_healthcheck_timeout_ms=_integer(environ, "SMTP_HEALTHCHECK_TIMEOUT_MS"),
+        healthcheck_history_size=history_size,
+        healthcheck_failures=failures,
+        healthcheck_successes=successes,
+        healthcheck_degraded_ms=_integer(environ, "HEALTHCHECK_DEGRADED_MS"),
+        healthcheck_ewma_alpha=alpha,
+        passive_healthcheck_idle_ms=_integer(environ, "PASSIVE_HEALTHCHECK_IDLE_MS"),
+        fingerprint=fingerprint(environ),
+        ports=tuple(
+            PortPlan(
+                port=port,
+                listen_address="",
+                backlog=socket.SOMAXCONN,
+                reuse_address=True,
+                upstream_port=int(port),
+                max_connections=max_connections,
+                connect_timeout_ms=connect_timeout_ms,
+                http_check_url=http_url if port == http_port else None,
+                smtp_check_url=smtp_url if port == smtp_port else None,
+            )
+            for port in ports
+        ),
+    )
+
+
+def _plan_file():
+    from tempfile import gettempdir
+
+    return os.path.join(gettempdir(), PLAN_FILE)
+
+
+def save_plan(plan):
+    """
+    Cache plan for healthcheck
+    :return: None
+    """
+    plan_file = _plan_file()
+    data = plan._asdict()
+    data["ports"] = [port._asdict() for port in plan.ports]
+    with open(f"{plan_file}.tmp", "w") as fp:
+        json.dump(data, fp)
+    os.replace(f"{plan_file}.tmp", plan_file)
+
+
+def load_plan(environ=None):
+    """
+    Load the plan cached by proxy.py, compiling it if there is none for the current configuration
+    :return: the Plan
+    """
+    environ = os.environ if environ is None else environ
+    try:
+        with open(_plan_file()) as fp:
+            data = json.load(fp)
+        if data["fingerprint"] == fingerprint(environ):
+            data["nameservers"] = tuple(data["nameservers"])
+            data["ports"] = tuple(PortPlan(**port) for port in data["ports"])
+            return Plan(**data)
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        # missing or written by another version, compile it below
+        pass
+    return compile_plan(environ)
@@ -3,6 +3,8 @@
 import logging
 import os
 
+from config import PROBE_ADDRESS, load_plan
+
 logger = logging.getLogger("healthcheck")
 
 
@@ -14,28 +16,15 @@ def error(message, exception=None):
         raise exception
 
 
-def http_healthcheck():
+def http_healthcheck(plan=None):
     """
     Use pycurl to check if the target server is still responding via proxy.py
     :return: None
     """
-    import re
-
     import pycurl
 
-    check_url = os.environ.get("HTTP_HEALTHCHECK_URL", "http://localhost/")
-    check_timeout_ms = int(os.environ.get("HTTP_HEALTHCHECK_TIMEOUT_MS", 2000))
-    target = os.environ.get("TARGET", "localhost")
-    check_url_with_target = check_url.replace("$TARGET", target)
-    port = re.search("https?://[^:]*(?::([^/]+))?", check_url_with_target)[1]
-    if not port:
-        port = "80" if check_url_with_target.startswith("http://") else "443"
-        ports = os.environ.get("PORT").split()
-        if port not in ports:
-            port = ports[0]
-            check_url_with_target = re.sub(
-                "(https?://[^/]+)", r"\1:{}".format(port), check_url_with_target
-            )
+    plan = plan or load_plan()
+    check_url_with_target, port = plan.check("http")
     print("checking %s via 127.0.0.1" % check_url_with_target)
     logger.info("checking %s via 127.0.0.1" % check_url_with_target)
     try:
@@ -43,55 +32,168 @@ def http_healthcheck():
         request.setopt(pycurl.URL, check_url_with_target)
         # do not send the request to the target directly but use our own socat proxy process to check if it's still
         # working
-        request.setopt(pycurl.RESOLVE, ["{}:{}:127.0.0.1".format(target, port)])
-        request.setopt(pycurl.CONNECTTIMEOUT_MS, check_timeout_ms)
-        request.setopt(pycurl.TIMEOUT_MS, check_timeout_ms)
+        request.setopt(
+            pycurl.RESOLVE, ["{}:{}:127.0.0.1".format(plan.target, port.port)]
+        )
+        request.setopt(pycurl.INTERFACE, "host!{}".format(PROBE_ADDRESS))
+        request.setopt(pycurl.CONNECTTIMEOUT_MS, plan.http_healthcheck_timeout_ms)
+        request.setopt(pycurl.TIMEOUT_MS, plan.http_healthcheck_timeout_ms)
         request.perform()
         request.close()
     except pycurl.error as e:
         error("error while checking http connection", e)
 
 
-def smtp_healthcheck():
+def smtp_healthcheck(plan=None):
     """
     Use pycurl to check if the target server is still responding via proxy.py
     :return: None
     """
-    import re
-
     import pycurl
 
-    check_url = os.environ.get("SMTP_HEALTHCHECK_URL", "smtp://localhost/")
-    check_command = os.environ.get("SMTP_HEALTHCHECK_COMMAND", "HELP")
-    check_timeout_ms = int(os.environ.get("SMTP_HEALTHCHECK_TIMEOUT_MS", 2000))
-    target = os.environ.get("TARGET", "localhost")
-    check_url_with_target = check_url.replace("$TARGET", target)
-    port = re.search("smtp://[^:]*(?::([^/]+))?", check_url_with_target)[1]
-    if not port:
-        port = "25"
-        ports = os.environ.get("PORT").split()
-        if port not in ports:
-            port = ports[0]
-            check_url_with_target = re.sub(
-                "(smtp://[^/]+)", r"\1:{}".format(port), check_url_with_target
-            )
+    plan = plan or load_plan()
+    check_url_with_target, port = plan.check("smtp")
     logger.info("checking %s via 127.0.0.1" % check_url_with_target)
     try:
         request = pycurl.Curl()
         request.setopt(pycurl.URL, check_url_with_target)
-        request.setopt(pycurl.CUSTOMREQUEST, check_command)
+        request.setopt(pycurl.CUSTOMREQUEST, plan.smtp_healthcheck_command)
         # do not send the request to the target directly but use our own socat proxy process to check if it's still
         # working
-        request.setopt(pycurl.RESOLVE, ["{}:{}:127.0.0.1".format(target, port)])
-        request.setopt(pycurl.CONNECTTIMEOUT_MS, check_timeout_ms)
-        request.setopt(pycurl.TIMEOUT_MS, check_timeout_ms)
+        request.setopt(
+            pycurl.RESOLVE, ["{}:{}:127.0.0.1".format(plan.target, port.port)]
+        )
+        request.setopt(pycurl.INTERFACE, "host!{}".format(PROBE_ADDRESS))
+        request.setopt(pycurl.CONNECTTIMEOUT_MS, plan.smtp_healthcheck_timeout_ms)
+        request.setopt(pycurl.TIMEOUT_MS, plan.smtp_healthcheck_timeout_ms)
         request.perform()
         request.close()
     except pycurl.error as e:
         error("error while checking smtp connection", e)
 
 
-def process_healthcheck():
+def record_probe(name, ok, latency_ms, plan=None):
+    """
+    Add the result of an active probe to its persisted history and derive the state to report from it, so a single
+    slow or failed probe doesn't make the container unhealthy
+    :return: "healthy", "degraded" or "unhealthy"
+    """
+    import json
+    import time
+    from tempfile import gettempdir
+
+    plan = plan or load_plan()
+    history_size = plan.healthcheck_history_size
+    max_failures = plan.healthcheck_failures
+    min_successes = plan.healthcheck_successes
+    degraded_ms = plan.healthcheck_degraded_ms
+    alpha = plan.healthcheck_ewma_alpha
+    history_file = os.path.join(gettempdir(), f"healthcheck_{name}.json")
+    try:
+        with open(history_file) as fp:
+            history = json.load(fp)
+    except (FileNotFoundError, ValueError):
+        history = {"results": [], "ewma_ms": None, "state": "healthy"}
+    results = history["results"]
+    results.append({"time": time.time(), "ok": ok, "latency_ms": latency_ms})
+    del results[:-history_size]
+    if ok:
+        # failed probes mostly ran into the timeout, so only successful ones feed the latency average
+        if history["ewma_ms"] is None:
+            history["ewma_ms"] = latency_ms
+        else:
+            history["ewma_ms"] = alpha * latency_ms + (1 - alpha) * history["ewma_ms"]
+    # count the trailing run of equal results
+    streak = 0
+    for result in reversed(results):
+        if result["ok"] != ok:
+            break
+        streak += 1
+    if history["state"] == "unhealthy":
+        # hysteresis, once unhealthy only a run of successful probes makes us healthy again
+        unhealthy = not ok or streak < min_successes
+    else:
+        unhealthy = not ok and streak >= max_failures
+    if unhealthy:
+        history["state"] = "unhealthy"
+    elif degraded_ms and history["ewma_ms"] and history["ewma_ms"] > degraded_ms:
+        history["state"] = "degraded"
+    else:
+        history["state"] = "healthy"
+    with open(f"{history_file}.tmp", "w") as fp:
+        json.dump(history, fp)
+    os.replace(f"{history_file}.tmp", history_file)
+    logger.info(
+        "%s probe %s in %d ms, average %d ms, %s"
+        % (
+            name,
+            "succeeded" if ok else "failed",
+            latency_ms,
+            history["ewma_ms"] or 0,
+            history["state"],
+        )
+    )
+    return history["state"]
+
+
+def passive_healthcheck(port, plan=None):
+    """
+    Check if real clients recently connected to the target through the relay for port, so the active probe can be
+    skipped
+    :return: the average time to first byte of the target in ms or None if the active probe is needed
+    """
+    import time
+
+    plan = plan or load_plan()
+    idle_ms = plan.passive_healthcheck_idle_ms
+    if not idle_ms or plan.engine != "asyncio":
+        return None
+    status = read_status(port)
+    if not status or not status.get("last_success") or status["ttfb_ms"] is None:
+        return None
+    idle_for_ms = (time.time() - status["last_success"]) * 1000
+    if idle_for_ms > idle_ms or status["consecutive_failures"]:
+        # no recent traffic or real clients failing, only the active probe can tell
+        return None
+    logger.info(
+        "port %s connected a client %d ms ago, skipping active probe"
+        % (port, idle_for_ms)
+    )
+    return status["ttfb_ms"]
+
+
+def damped_healthcheck(name, check, port=None, plan=None):
+    """
+    Run the active probe check, unless real traffic through port shows the target is fine, and fail only if its
+    recent history says the target is unhealthy
+    :return: None
+    """
+    import time
+
+    import pycurl
+
+    plan = plan or load_plan()
+    latency_ms = None if port is None else passive_healthcheck(port, plan)
+    ok = True
+    if latency_ms is None:
+        start = time.monotonic()
+        try:
+            check(plan)
+        except pycurl.error:
+            ok = False
+        latency_ms = (time.monotonic() - start) * 1000
+    state = record_probe(name, ok, latency_ms, plan)
+    if state == "unhealthy":
+        error("%s healthcheck is unhealthy" % name)
+    if state == "degraded":
+        print("%s healthcheck is degraded" % name)
+        logger.warning(
+            "%s healthcheck is degraded, latency above %s ms"
+            % (name, plan.healthcheck_degraded_ms)
+        )
+
+
+def process_healthcheck(plan=None):
     """
     Check that at least one socat process exists per port and no more than the number of configured max connections
     processes exist for each port.
@@ -99,8 +201,9 @@ def process_healthcheck():
     """
     import subprocess
 
-    ports = os.environ["PORT"].split()
-    max_connections = int(os.environ["MAX_CONNECTIONS"])
+    plan = plan or load_plan()
+    ports = [port.port for port in plan.ports]
+    max_connections = max(port.max_connections for port in plan.ports)
     logger.info(
         "checking socat processes for port(s) %s having at least one and less than %d socat processes"
         % (ports, max_connections)
@@ -156,13 +259,47 @@ def process_healthcheck():
             )
 
 
-def preresolve_healthcheck():
+def read_status(port):
+    """
+    Read the status persisted by the asyncio engine of proxy.py for port
+    :return: the status dict or None if the relay didn't write one yet
+    """
+    import json
+    from tempfile import gettempdir
+
+    try:
+        with open(os.path.join(gettempdir(), f"proxy_status_{port}.json")) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def circuit_breaker_healthcheck(plan=None):
+    """
+    Check that the circuit breaker of every port is closed. It is open while the target is unreachable for real
+    clients, and stays half-open until a client or the http/smtp healthcheck connects again
+    :return: None
+    """
+    plan = plan or load_plan()
+    for port in (port.port for port in plan.ports):
+        status = read_status(port)
+        if status is None:
+            error("Missing status of the relay for port: %s" % port)
+        logger.info(
+            "circuit breaker for port %s is %s" % (port, status["circuit_breaker"])
+        )
+        if status["circuit_breaker"] != "closed":
+            error("Circuit breaker %s for port: %s" % (status["circuit_breaker"], port))
+
+
+def preresolve_healthcheck(plan=None):
     """
     Check that the pre-resolved ip is still valid now for target
     :return:
     """
     from tempfile import gettempdir
 
+    plan = plan or load_plan()
     load_balancing_dns_fs_flag = os.path.join(
         gettempdir(), "load_balancing_dns_detected"
     )
@@ -172,22 +309,30 @@ def preresolve_healthcheck():
 
         from dns.resolver import Resolver
 
-        pre_resolved_ips = {
-            line.split(":")[2]
-            for line in subprocess.check_output(
-                [
-                    "sh",
-                    "-c",
-                    "grep -R -s '\\(udp\\|tcp\\)-connect:' /proc/[0-9]*/cmdline || grep -R -s '\\(udp\\|tcp\\)-connect:' /proc/[0-9]*/cmdline",
-                ]
-            )
-            .decode("utf-8")
-            .split("\n")
-            if line
-        }
+        if plan.engine == "asyncio":
+            # the relay runs in process, there is no socat command line with the ip
+            pre_resolved_ips = {
+                status["ip"]
+                for status in (read_status(port.port) for port in plan.ports)
+                if status and status["ip"]
+            }
+        else:
+            pre_resolved_ips = {
+                line.split(":")[2]
+                for line in subprocess.check_output(
+                    [
+                        "sh",
+                        "-c",
+                        "grep -R -s '\\(udp\\|tcp\\)-connect:' /proc/[0-9]*/cmdline || grep -R -s '\\(udp\\|tcp\\)-connect:' /proc/[0-9]*/cmdline",
+                    ]
+                )
+                .decode("utf-8")
+                .split("\n")
+                if line
+            }
         resolver = Resolver()
-        resolver.nameservers = os.environ["NAMESERVERS"].split()
-        target = os.environ["TARGET"]
+        resolver.nameservers = list(plan.nameservers)
+        target = plan.target
         resolved_ips = [answer.address for answer in resolver.resolve(target)]
         for ip in pre_resolved_ips:
             logger.info(f"checking {target} resolves to {ip}")
@@ -214,10 +359,15 @@ def preresolve_healthcheck():
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    process_healthcheck()
-    if os.environ["PRE_RESOLVE"] == "1":
-        preresolve_healthcheck()
-    if os.environ.get("HTTP_HEALTHCHECK", "0") == "1":
-        http_healthcheck()
-    if os.environ.get("SMTP_HEALTHCHECK", "0") == "1":
-        smtp_healthcheck()
+    plan = load_plan()
+    if plan.engine != "asyncio":
+        process_healthcheck(plan)
+    if plan.pre_resolve:
+        preresolve_healthcheck(plan)
+    if plan.http_healthcheck:
+        damped_healthcheck("http", http_healthcheck, plan.check("http")[1].port, plan)
+    if plan.smtp_healthcheck:
+        damped_healthcheck("smtp", smtp_healthcheck, plan.check("smtp")[1].port, plan)
+    if plan.engine == "asyncio":
+        # after the probes, a probe let through by a half-open circuit breaker closes it if the target is back
+        circuit_breaker_healthcheck(plan)
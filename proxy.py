@@ -1,50 +1,546 @@
 #!/usr/bin/env python3
 
 import asyncio
+import json
 import logging
 import os
-import random
+import sys
+import time
 
-from dns.resolver import Resolver
+import config
 
-logging.root.setLevel(logging.INFO)
-mode = os.environ["MODE"]
-ports = os.environ["PORT"].split()
-max_connections = os.environ.get("MAX_CONNECTIONS", 100)
-ip = target = os.environ["TARGET"]
-udp_answers = os.environ.get("UDP_ANSWERS", "1")
 
-# Resolve target if required
-if os.environ["PRE_RESOLVE"] == "1":
+def resolve(target, nameservers):
+    """
+    Resolve target with the given nameservers and pick one of the answers
+    :return: the ip address to proxy to
+    """
+    import random
+
+    from dns.resolver import Resolver
+
     resolver = Resolver()
-    resolver.nameservers = os.environ["NAMESERVERS"].split()
+    resolver.nameservers = nameservers
     ip = random.choice([answer.address for answer in resolver.resolve(target)])
     logging.info("Resolved %s to %s", target, ip)
+    return ip
+
+
+def listen(port):
+    """
+    Bind a tcp listening socket for the PortPlan port, connecting clients wait in its backlog until they are accepted
+    :return: the listening socket
+    """
+    import socket
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if port.reuse_address:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((port.listen_address, int(port.port)))
+    listener.listen(port.backlog)
+    listener.set_inheritable(True)
+    return listener
+
+
+def write_status(port, status):
+    """
+    Persist the status of the relay for port, so healthcheck can read it without probing the network
+    :return: None
+    """
+    from tempfile import gettempdir
+
+    status_file = os.path.join(gettempdir(), f"proxy_status_{port}.json")
+    with open(f"{status_file}.tmp", "w") as fp:
+        json.dump(status, fp)
+    # replace atomically so healthcheck never reads a partially written file
+    os.replace(f"{status_file}.tmp", status_file)
+
+
+def clear_state():
+    """
+    Remove the state files of a previous run, they would survive restarting the container
+    :return: None
+    """
+    import glob
+    from tempfile import gettempdir
+
+    for pattern in ("proxy_status_*.json", "healthcheck_*.json"):
+        for state_file in glob.glob(os.path.join(gettempdir(), pattern)):
+            os.remove(state_file)
+
+
+class CircuitBreaker:
+    """
+    Reject clients right away while the target keeps failing to accept connections, instead of letting every
+    client wait for its own connect to time out.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failures, window_ms, reset_ms, probes, on_change=None):
+        self.max_failures = failures
+        self.window = window_ms / 1000
+        self.reset = reset_ms / 1000
+        self.max_probes = probes
+        self.on_change = on_change
+        self.state = self.CLOSED
+        self.failures = []
+        self.opened_at = 0
+        self.probes = 0
+
+    def _set_state(self, state):
+        if state != self.state:
+            logging.warning("Circuit breaker %s -> %s", self.state, state)
+            self.state = state
+            if self.on_change is not None:
+                self.on_change(state)
+
+    def allow(self):
+        """
+        Check if a new client may try to connect to the target
+        :return: True if the connect should be attempted
+        """
+        if not self.max_failures:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset:
+                return False
+            self.half_open()
+        if self.state == self.HALF_OPEN:
+            # let only a trickle of probe connects through until one of them succeeds
+            if self.probes >= self.max_probes:
+                return False
+            self.probes += 1
+        return True
+
+    def half_open(self):
+        """
+        Let probe connects through again, called by allow() or by a timer once the reset time passed
+        :return: None
+        """
+        if self.state == self.OPEN:
+            self.probes = 0
+            self._set_state(self.HALF_OPEN)
+
+    def success(self):
+        if not self.max_failures:
+            return
+        self.failures.clear()
+        self.probes = 0
+        self._set_state(self.CLOSED)
+
+    def failure(self):
+        if not self.max_failures:
+            return
+        now = time.monotonic()
+        if self.state == self.HALF_OPEN:
+            self.probes = 0
+        else:
+            # only consecutive failures inside the window count
+            self.failures = [
+                failure for failure in self.failures if now - failure < self.window
+            ]
+            self.failures.append(now)
+            if len(self.failures) < self.max_failures:
+                return
+        self.failures.clear()
+        self.opened_at = now
+        self._set_state(self.OPEN)
+
+
+class BufferPool:
+    """
+    Size classed pool of relay buffers shared by all connections, a connection only borrows a buffer while data is
+    in flight, so idle connections don't hold any.
+    """
+
+    def __init__(self, sizes=(2048, 16384, 65536), max_free=64):
+        self.sizes = sizes
+        self.max_free = max_free
+        self.free = {size: [] for size in sizes}
+
+    def acquire(self, size_class):
+        free = self.free[self.sizes[size_class]]
+        return free.pop() if free else bytearray(self.sizes[size_class])
+
+    def release(self, buffer):
+        free = self.free[len(buffer)]
+        if len(free) < self.max_free:
+            free.append(buffer)
+
+
+class Endpoint(asyncio.BufferedProtocol):
+    """
+    One side of a relayed connection, forwarding everything it receives to its peer
+    """
+
+    __slots__ = ("relay", "peer", "transport", "buffer", "size_class", "eof")
+
+    def __init__(self, relay, peer=None):
+        self.relay = relay
+        self.peer = peer
+        self.transport = None
+        self.buffer = None
+        self.size_class = 0
+        self.eof = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if self.buffer is None:
+            self.buffer = self.relay.pool.acquire(self.size_class)
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        buffer, self.buffer = self.buffer, None
+        peer_transport = self.peer.transport
+        peer_transport.write(memoryview(buffer)[:nbytes])
+        # grow the buffer for bulk transfers, shrink it back for chatty ones
+        if nbytes == len(buffer) and self.size_class + 1 < len(self.relay.pool.sizes):
+            self.size_class += 1
+        elif self.size_class and nbytes <= self.relay.pool.sizes[self.size_class - 1]:
+            self.size_class -= 1
+        # if not everything could be sent right away, the transport may still reference the buffer
+        if not peer_transport.get_write_buffer_size():
+            self.relay.pool.release(buffer)
+
+    def eof_received(self):
+        self.eof = True
+        if self.peer is None or self.peer.eof:
+            # both directions are done, close the connection
+            return False
+        if self.peer.transport.can_write_eof():
+            self.peer.transport.write_eof()
+        return True
+
+    def pause_writing(self):
+        # stop reading from the peer until we caught up with writing its data
+        if self.peer is not None:
+            self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.peer is not None:
+            self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self.buffer is not None:
+            self.relay.pool.release(self.buffer)
+            self.buffer = None
+        if self.peer is not None:
+            self.peer.transport.close()
 
 
-async def netcat(port):
+class Connection(Endpoint):
+    """
+    The client side of a relayed connection, connecting to the target once accepted
+    """
+
+    __slots__ = ("pending",)
+
+    def __init__(self, relay):
+        super().__init__(relay)
+        self.pending = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # don't read from the client before the target is connected
+        transport.pause_reading()
+        self.relay.connect(self)
+
+    def buffer_updated(self, nbytes):
+        if self.peer is None:
+            # uvloop starts reading after connection_made even if it paused reading, keep the data until the
+            # target is connected
+            self.transport.pause_reading()
+            self.pending = nbytes
+            return
+        if self.peer.waiting:
+            self.peer.request_sent()
+        super().buffer_updated(nbytes)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if self.peer is not None:
+            self.relay.connections.release()
+
+
+class Upstream(Endpoint):
+    """
+    The target side of a relayed connection, measuring the time until the target sends its first byte
+    """
+
+    __slots__ = ("connected_at", "waiting")
+
+    def __init__(self, relay, peer):
+        super().__init__(relay, peer)
+        self.connected_at = 0
+        # no byte was exchanged yet, the clock starts at the connect in case the target speaks first (e.g. smtp)
+        self.waiting = True
+
+    def request_sent(self):
+        # the client speaks first (e.g. http), time the answer to its request and not how long the client waited
+        # before sending it, like connection pools opening connections ahead of time do
+        if self.connected_at:
+            self.connected_at = time.monotonic()
+        self.waiting = False
+
+    def buffer_updated(self, nbytes):
+        self.waiting = False
+        if self.connected_at:
+            self.relay.first_byte((time.monotonic() - self.connected_at) * 1000)
+            self.connected_at = 0
+        super().buffer_updated(nbytes)
+
+
+class Relay:
+    """
+    Forward the tcp connections for a port to the target from within this process
+    """
+
+    def __init__(self, plan, port, ip, pool):
+        self.port = port.port
+        self.upstream_port = port.upstream_port
+        self.ip = ip
+        self.pool = pool
+        self.connections = asyncio.Semaphore(port.max_connections)
+        self.connect_timeout = port.connect_timeout_ms / 1000
+        self.status = {
+            "ip": None,
+            "circuit_breaker": CircuitBreaker.CLOSED,
+            # connects of real clients, for passive health detection
+            "last_success": None,
+            "last_failure": None,
+            "consecutive_failures": 0,
+            "ttfb_ms": None,
+        }
+        self.ttfb_alpha = plan.healthcheck_ewma_alpha
+        self.save_handle = None
+        self.reset_handle = None
+        self.breaker = CircuitBreaker(
+            plan.circuit_breaker_failures,
+            plan.circuit_breaker_window_ms,
+            plan.circuit_breaker_reset_ms,
+            plan.circuit_breaker_probes,
+            self.on_change,
+        )
+        # keep references to pending connects, the loop only keeps weak ones
+        self.connecting = set()
+
+    def on_change(self, state):
+        self.status["circuit_breaker"] = state
+        write_status(self.port, self.status)
+        if self.reset_handle is not None:
+            self.reset_handle.cancel()
+            self.reset_handle = None
+        if state == CircuitBreaker.OPEN:
+            # without new clients allow() wouldn't notice the reset time passed, and healthcheck would report the
+            # breaker open until the container restarts
+            self.reset_handle = asyncio.get_running_loop().call_later(
+                self.breaker.reset, self.breaker.half_open
+            )
+
+    def save_status(self):
+        # real traffic may connect thousands of times per minute, write the status once per second at most
+        if self.save_handle is None:
+            self.save_handle = asyncio.get_running_loop().call_later(
+                1, self._save_status
+            )
+
+    def _save_status(self):
+        self.save_handle = None
+        write_status(self.port, self.status)
+
+    def connected(self, ok):
+        if ok:
+            self.status["last_success"] = time.time()
+            self.status["consecutive_failures"] = 0
+        else:
+            self.status["last_failure"] = time.time()
+            self.status["consecutive_failures"] += 1
+        self.save_status()
+
+    def first_byte(self, ttfb_ms):
+        if self.status["ttfb_ms"] is None:
+            self.status["ttfb_ms"] = ttfb_ms
+        else:
+            self.status["ttfb_ms"] = (
+                self.ttfb_alpha * ttfb_ms
+                + (1 - self.ttfb_alpha) * self.status["ttfb_ms"]
+            )
+        self.save_status()
+
+    def connect(self, connection):
+        task = asyncio.ensure_future(self._connect(connection))
+        self.connecting.add(task)
+        task.add_done_callback(self.connecting.discard)
+
+    async def _connect(self, connection):
+        await self.connections.acquire()
+        try:
+            ip = await self.ip
+            if connection.transport.is_closing():
+                return
+            if not self.breaker.allow():
+                # fast-fail, the client gets a reset instead of waiting for a doomed connect
+                connection.transport.abort()
+                return
+            # only real clients count for passive health detection, not the healthcheck probes
+            client = (
+                connection.transport.get_extra_info("peername", (None,))[0]
+                != config.PROBE_ADDRESS
+            )
+            loop = asyncio.get_running_loop()
+            try:
+                _, upstream = await asyncio.wait_for(
+                    loop.create_connection(
+                        lambda: Upstream(self, connection), ip, self.upstream_port
+                    ),
+                    self.connect_timeout,
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.error(
+                    "Connecting to %s:%s failed: %r", ip, self.upstream_port, e
+                )
+                self.breaker.failure()
+                if client:
+                    self.connected(False)
+                connection.transport.abort()
+                return
+            self.breaker.success()
+            if client:
+                self.connected(True)
+                upstream.connected_at = time.monotonic()
+            if connection.transport.is_closing():
+                upstream.transport.close()
+                return
+            connection.peer = upstream
+            if connection.pending:
+                connection.buffer_updated(connection.pending)
+            connection.transport.resume_reading()
+        finally:
+            if connection.peer is None:
+                self.connections.release()
+
+
+async def relay(plan, port, ip, listener, pool=None):
+    """
+    Relay the tcp connections for the PortPlan port in process
+    :return: None
+    """
+    relay = Relay(plan, port, ip, pool or BufferPool())
+    loop = asyncio.get_running_loop()
+    # keep the backlog of listen(), asyncio would shrink it to 100 otherwise
+    server = await loop.create_server(
+        lambda: Connection(relay), sock=listener, backlog=port.backlog
+    )
+    relay.status["ip"] = await ip
+    write_status(port.port, relay.status)
+    logging.info(
+        "Relaying port %s to %s:%s", port.port, relay.status["ip"], port.upstream_port
+    )
+    async with server:
+        await server.serve_forever()
+
+
+async def netcat(plan, port, ip, listener=None):
     # Use a persistent BusyBox netcat server in listening mode
     command = ["socat"]
     # Verbose mode
-    if os.environ["VERBOSE"] == "1":
+    if plan.verbose:
         command.append("-v")
-    if mode == "udp" and udp_answers == "0":
-        command += [f"udp-recv:{port},reuseaddr", f"udp-sendto:{ip}:{port}"]
+    # Wait for the target to be resolved, clients are held in the backlog of listener meanwhile
+    ip = await ip
+    mode = plan.mode
+    upstream = f"{ip}:{port.upstream_port}"
+    if mode == "udp" and not plan.udp_answers:
+        command += [f"udp-recv:{port.port},reuseaddr", f"udp-sendto:{upstream}"]
+    elif listener is not None:
+        command += [
+            f"accept-fd:{listener.fileno()},fork,max-children={port.max_connections}",
+            f"{mode}-connect:{upstream}",
+        ]
     else:
         command += [
-            f"{mode}-listen:{port},fork,reuseaddr,max-children={max_connections}",
-            f"{mode}-connect:{ip}:{port}",
+            f"{mode}-listen:{port.port},fork,reuseaddr,max-children={port.max_connections}",
+            f"{mode}-connect:{upstream}",
         ]
     # Create the process and wait until it exits
     logging.info("Executing: %s", " ".join(command))
-    process = await asyncio.create_subprocess_exec(*command)
+    pass_fds = () if listener is None else (listener.fileno(),)
+    process = await asyncio.create_subprocess_exec(*command, pass_fds=pass_fds)
+    if listener is not None:
+        # socat owns its inherited copy of the listening socket now
+        listener.close()
     await process.wait()
 
 
-# Wait until all proxies exited, if they ever do
-try:
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.gather(*map(netcat, ports)))
-finally:
-    loop.run_until_complete(loop.shutdown_asyncgens())
-    loop.close()
+async def serve(plan):
+    """
+    Start one proxy per port of plan, binding tcp listeners before the target is resolved
+    :return: None
+    """
+    loop = asyncio.get_running_loop()
+    listeners = dict.fromkeys(plan.ports)
+    if plan.engine == "asyncio" or (plan.pre_resolve and plan.mode == "tcp"):
+        listeners = {port: listen(port) for port in plan.ports}
+    ip = loop.create_future()
+    if plan.pre_resolve:
+        # Resolve target in the background, so resolving doesn't delay listening
+        ip = loop.run_in_executor(None, resolve, plan.target, list(plan.nameservers))
+    else:
+        ip.set_result(plan.target)
+    if plan.engine == "asyncio":
+        pool = BufferPool()
+        proxies = (relay(plan, port, ip, listeners[port], pool) for port in plan.ports)
+    else:
+        proxies = (netcat(plan, port, ip, listeners[port]) for port in plan.ports)
+    try:
+        await asyncio.gather(*proxies)
+    finally:
+        for listener in listeners.values():
+            if listener is not None:
+                listener.close()
+
+
+def new_event_loop(event_loop="asyncio"):
+    """
+    Create the event loop selected with EVENT_LOOP, falling back to the asyncio one if uvloop isn't installed
+    :return: the new event loop
+    """
+    if event_loop == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning("uvloop is not installed, using the asyncio event loop")
+        else:
+            logging.info("Using the uvloop event loop")
+            return uvloop.new_event_loop()
+    logging.info("Using the asyncio event loop")
+    return asyncio.new_event_loop()
+
+
+def main():
+    logging.root.setLevel(logging.INFO)
+    # Validate the configuration once, healthcheck loads the cached plan
+    try:
+        plan = config.compile_plan()
+    except ValueError as e:
+        logging.error("Invalid configuration: %s", e)
+        sys.exit(1)
+    clear_state()
+    config.save_plan(plan)
+    loop = new_event_loop(plan.event_loop)
+    asyncio.set_event_loop(loop)
+    # Wait until all proxies exited, if they ever do
+    try:
+        loop.run_until_complete(serve(plan))
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+benchmark the in process relay of proxy.py (ENGINE=asyncio). the relay runs in its own process, so its resident memory
+can be measured while holding idle connections.
+
+every available event loop (see EVENT_LOOP) is benchmarked, to compare them.
+
+usage: python tests/benchmark.py [connections]
+"""
+import asyncio
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+import proxy  # noqa: E402
+
+RELAY_ADDRESS = "127.0.0.1"
+# the relay connects to the same port on the target, so the target listens on another loopback address
+TARGET_ADDRESS = "127.0.0.2"
+
+
+def rss(pid):
+    """
+    :return: the resident set size of process pid in bytes
+    """
+    with open("/proc/%d/status" % pid) as fp:
+        for line in fp:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+
+
+def raise_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def run_relay(port, connections, event_loop):
+    raise_open_files_limit()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((RELAY_ADDRESS, port))
+    listener.listen(socket.SOMAXCONN)
+
+    plan = config.compile_plan(
+        {
+            "TARGET": TARGET_ADDRESS,
+            "PORT": str(port),
+            "ENGINE": "asyncio",
+            "EVENT_LOOP": event_loop,
+            "MAX_CONNECTIONS": str(connections),
+        }
+    )
+
+    async def _relay():
+        ip = asyncio.get_running_loop().create_future()
+        ip.set_result(TARGET_ADDRESS)
+        await proxy.relay(plan, plan.ports[0], ip, listener)
+
+    loop = proxy.new_event_loop(plan.event_loop)
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(_relay())
+
+
+def run_target(target, accepted):
+    # accept every connection from a thread and just keep it open
+    while True:
+        try:
+            connection, _ = target.accept()
+        except OSError:
+            return
+        accepted.append(connection)
+
+
+def connect(port):
+    client = socket.create_connection((RELAY_ADDRESS, port))
+    client.sendall(b"ping")
+    return client
+
+
+def wait_for(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError()
+        time.sleep(0.01)
+
+
+def benchmark(connections, event_loop):
+    """
+    open idle connections through the relay and measure the resident memory they take
+    :return: the rss per connection in bytes
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((RELAY_ADDRESS, 0))
+        port = sock.getsockname()[1]
+    target = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    target.bind((TARGET_ADDRESS, port))
+    target.listen(socket.SOMAXCONN)
+    accepted = []
+    threading.Thread(target=run_target, args=(target, accepted), daemon=True).start()
+    relay = multiprocessing.Process(
+        target=run_relay, args=(port, connections + 1, event_loop)
+    )
+    relay.start()
+    clients = []
+    try:
+        # warm up the relay, so its buffers and code paths are in place before measuring
+        wait_for(lambda: _warm_up(port, clients))
+        wait_for(lambda: len(accepted) == 1)
+        baseline = rss(relay.pid)
+        start = time.monotonic()
+        while len(clients) < connections + 1:
+            clients.append(connect(port))
+        wait_for(lambda: len(accepted) == len(clients))
+        for connection in accepted:
+            # every connection relayed data once, so it would hold a buffer if it didn't return it to the pool
+            assert connection.recv(4) == b"ping"
+        elapsed = time.monotonic() - start
+        per_connection = (rss(relay.pid) - baseline) / connections
+    finally:
+        relay.kill()
+        relay.join()
+        target.close()
+        for sock in clients + accepted:
+            sock.close()
+    print("event loop:               %s" % event_loop)
+    print("connections:              %d" % connections)
+    print("connections/s:            %.0f" % (connections / elapsed))
+    print("rss per connection:       %.0f bytes" % per_connection)
+    return per_connection
+
+
+def _warm_up(port, clients):
+    try:
+        clients.append(connect(port))
+        return True
+    except ConnectionRefusedError:
+        # the relay is still starting
+        return False
+
+
+if __name__ == "__main__":
+    limit = raise_open_files_limit()
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    # every relayed connection takes two sockets in this process and two in the relay
+    connections = min(connections, limit // 2 - 100)
+    event_loops = ["asyncio"]
+    try:
+        import uvloop  # noqa: F401
+
+        event_loops.append("uvloop")
+    except ImportError:
+        print("uvloop is not installed, benchmarking the asyncio event loop only")
+    for event_loop in event_loops:
+        benchmark(connections, event_loop)
+        print()
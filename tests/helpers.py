@@ -0,0 +1,63 @@
+"""
+Helpers shared by the unit tests of proxy.py, healthcheck.py and config.py
+"""
+import asyncio
+import socket
+import tempfile
+from contextlib import asynccontextmanager
+from unittest import TestCase
+from unittest.mock import patch
+
+RELAY_ADDRESS = "127.0.0.1"
+# the relay connects to the same port on the target, so the target listens on another loopback address
+TARGET_ADDRESS = "127.0.0.2"
+
+
+def free_port():
+    """
+    :return: a port nothing listens on yet on the loopback address
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((RELAY_ADDRESS, 0))
+        return str(sock.getsockname()[1])
+
+
+class TempDirTestCase(TestCase):
+    """
+    Point tempfile.gettempdir to a fresh directory per test, so the status, history and plan files written there
+    don't leak between tests or into the temp dir of the machine running them
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        gettempdir = patch("tempfile.gettempdir", return_value=tmp_dir.name)
+        gettempdir.start()
+        self.addCleanup(gettempdir.stop)
+
+
+@asynccontextmanager
+async def running_relay(environ=None):
+    """
+    Run the asyncio engine of proxy.py configured by environ on a free port of RELAY_ADDRESS, forwarding to the same
+    port of TARGET_ADDRESS
+    :return: the port and the buffer pool of the relay
+    """
+    import proxy
+    from config import compile_plan
+
+    port = free_port()
+    plan = compile_plan(
+        dict({"TARGET": "localhost", "ENGINE": "asyncio"}, **(environ or {}), PORT=port)
+    )
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind((RELAY_ADDRESS, int(port)))
+    listener.listen()
+    ip = asyncio.get_running_loop().create_future()
+    ip.set_result(TARGET_ADDRESS)
+    pool = proxy.BufferPool()
+    task = asyncio.ensure_future(proxy.relay(plan, plan.ports[0], ip, listener, pool))
+    try:
+        yield port, pool
+    finally:
+        task.cancel()
@@ -0,0 +1,148 @@
+import asyncio
+import os
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from helpers import RELAY_ADDRESS, TARGET_ADDRESS, TempDirTestCase, running_relay
+
+from healthcheck import circuit_breaker_healthcheck, read_status
+from proxy import CircuitBreaker
+
+
+@patch("time.monotonic", return_value=100)
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(3, 10000, 5000, 1)
+
+    def test_opens_after_consecutive_failures(self, mock_monotonic):
+        # given failures reaching the threshold within the window
+        for _ in range(3):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.failure()
+
+        # then the breaker should be open and reject new clients
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_ignores_failures_outside_window(self, mock_monotonic):
+        # given failures spread wider than the window
+        for now in (100, 106, 112):
+            mock_monotonic.return_value = now
+            self.breaker.failure()
+
+        # then the breaker should stay closed
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_success_resets_failures(self, mock_monotonic):
+        # given failures interrupted by a successful connect
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+
+        # then the breaker should stay closed
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_probes_trickle(self, mock_monotonic):
+        # given an open breaker whose reset time has passed
+        for _ in range(3):
+            self.breaker.failure()
+        mock_monotonic.return_value = 106
+
+        # then only one probe should be let through
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        # and a failed probe should open the breaker again
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        # and a successful probe should close it
+        mock_monotonic.return_value = 112
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_disabled(self, mock_monotonic):
+        # given a breaker disabled with 0 failures
+        on_change = MagicMock()
+        breaker = CircuitBreaker(0, 10000, 5000, 1, on_change)
+
+        # when connects keep failing
+        for _ in range(3):
+            self.assertTrue(breaker.allow())
+            breaker.failure()
+
+        # then the breaker should stay closed without reporting a change
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        on_change.assert_not_called()
+
+
+class TestRelayCircuitBreaker(TempDirTestCase):
+    async def _connect_clients(self, count, idle=0):
+        # nothing listens on the port of the target address, so every connect gets refused
+        async with running_relay(os.environ) as (port, _):
+            for _ in range(count):
+                # each client connects
+                reader, writer = await asyncio.open_connection(RELAY_ADDRESS, int(port))
+                # and gets disconnected
+                try:
+                    self.assertEqual(await reader.read(), b"")
+                except ConnectionResetError:
+                    pass
+                writer.close()
+            # then no client arrives anymore
+            await asyncio.sleep(idle)
+        return port
+
+    @patch.dict(
+        os.environ,
+        {"TARGET": "localhost", "ENGINE": "asyncio", "CIRCUIT_BREAKER_FAILURES": "2"},
+        clear=True,
+    )
+    def test_relay_opens_circuit_breaker(self):
+        # given a relay whose target refuses connections
+        with self.assertLogs(level="ERROR") as logs:
+            port = asyncio.run(self._connect_clients(4))
+        os.environ["PORT"] = port
+
+        # then clients after the threshold should not trigger connects anymore
+        self.assertEqual(
+            len(
+                [
+                    line
+                    for line in logs.output
+                    if "Connecting to %s" % TARGET_ADDRESS in line
+                ]
+            ),
+            2,
+        )
+        # and healthcheck should fail without probing the network
+        with self.assertRaises(SystemExit):
+            circuit_breaker_healthcheck()
+
+    @patch.dict(
+        os.environ,
+        {
+            "TARGET": "localhost",
+            "ENGINE": "asyncio",
+            "CIRCUIT_BREAKER_FAILURES": "2",
+            "CIRCUIT_BREAKER_RESET_MS": "100",
+        },
+        clear=True,
+    )
+    def test_relay_half_opens_without_clients(self):
+        # given a relay whose circuit breaker opened
+        with self.assertLogs(level="ERROR"):
+            # when no client arrives after the reset time passed
+            port = asyncio.run(self._connect_clients(2, idle=0.3))
+        os.environ["PORT"] = port
+
+        # then the breaker should be half-open to let the next connect through
+        self.assertEqual(read_status(port)["circuit_breaker"], "half-open")
+        # and healthcheck should still fail as no connect succeeded yet
+        with self.assertRaises(SystemExit):
+            circuit_breaker_healthcheck()
@@ -0,0 +1,78 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from helpers import TempDirTestCase
+
+from config import compile_plan, load_plan, save_plan
+
+
+class TestCompilePlan(TestCase):
+    def test_requires_target(self):
+        # given no target
+        # then compiling should fail
+        with self.assertRaisesRegex(ValueError, "TARGET"):
+            compile_plan({"PORT": "80"})
+
+    def test_rejects_invalid_values(self):
+        # given invalid values
+        for environ in (
+            {"PORT": "80 http"},
+            {"PORT": "80 80"},
+            {"MAX_CONNECTIONS": "many"},
+            {"MODE": "sctp"},
+            {"HEALTHCHECK_EWMA_ALPHA": "2"},
+            {"HEALTHCHECK_HISTORY_SIZE": "2", "HEALTHCHECK_FAILURES": "3"},
+            {"ENGINE": "asyncio", "MODE": "udp"},
+            {"HTTP_HEALTHCHECK": "1", "HTTP_HEALTHCHECK_URL": "http://localhost:8080/"},
+        ):
+            with self.subTest(environ=environ):
+                # then compiling should fail
+                with self.assertRaises(ValueError):
+                    compile_plan(dict({"TARGET": "example.com"}, **environ))
+
+    def test_plan_per_port(self):
+        # given a target proxied on several ports
+        plan = compile_plan(
+            {
+                "TARGET": "example.com",
+                "PORT": "80 443",
+                "MAX_CONNECTIONS": "10",
+                "HTTP_HEALTHCHECK": "1",
+                "HTTP_HEALTHCHECK_URL": "https://$TARGET/",
+            }
+        )
+
+        # then every port should get its own plan
+        self.assertEqual([port.port for port in plan.ports], ["80", "443"])
+        self.assertEqual([port.upstream_port for port in plan.ports], [80, 443])
+        # and the numbers should be parsed once
+        self.assertEqual(plan.ports[0].max_connections, 10)
+        # and the healthcheck should be assigned to the port of its url
+        self.assertEqual(plan.check("http"), ("https://example.com/", plan.ports[1]))
+        self.assertFalse(hasattr(plan.ports[0], "__dict__"))
+
+
+class TestLoadPlan(TempDirTestCase):
+    def test_loads_saved_plan(self):
+        # given a plan saved by proxy.py
+        environ = {"TARGET": "example.com", "PORT": "25", "NAMESERVERS": "8.8.8.8"}
+        plan = compile_plan(environ)
+        save_plan(plan)
+
+        # when loading it with the same configuration
+        with patch("config.compile_plan") as mock_compile_plan:
+            loaded = load_plan(environ)
+
+        # then it should be loaded unchanged without compiling it again
+        self.assertEqual(loaded, plan)
+        mock_compile_plan.assert_not_called()
+
+    def test_recompiles_outdated_plan(self):
+        # given a plan saved for another configuration
+        save_plan(compile_plan({"TARGET": "example.com", "PORT": "25"}))
+
+        # when loading it
+        plan = load_plan({"TARGET": "example.org", "PORT": "25"})
+
+        # then the current configuration should be used
+        self.assertEqual(plan.target, "example.org")
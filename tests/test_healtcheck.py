@@ -13,6 +13,7 @@ from plumbum.cmd import docker, which
 HEALTHCHECK_YAML = os.path.abspath("tests/healthcheck.yaml")
 
 PROXY_TARGET_PAIRS = [
+    ("proxy_asyncio", "target"),
     ("proxy_preresolve", "target"),
     ("proxy_smtp", "target_smtp"),
     ("proxy_without_preresolve", "target"),
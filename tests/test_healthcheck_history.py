@@ -0,0 +1,91 @@
+import os
+import tempfile
+from unittest.mock import patch
+
+import pycurl
+from helpers import TempDirTestCase
+
+from healthcheck import damped_healthcheck, record_probe
+
+
+def _failing_check(plan):
+    raise pycurl.error(28, "Operation timed out")
+
+
+def _succeeding_check(plan):
+    pass
+
+
+class TestHealthcheckHistory(TempDirTestCase):
+    # given default environment
+    @patch.dict(os.environ, {"TARGET": "localhost"}, clear=True)
+    def test_single_failure_is_unhealthy_by_default(self):
+        # when a single probe fails
+        # then healthcheck should fail right away
+        with self.assertRaises(SystemExit):
+            damped_healthcheck("http", _failing_check)
+
+    # given 3 failures are tolerated
+    @patch.dict(
+        os.environ, {"TARGET": "localhost", "HEALTHCHECK_FAILURES": "3"}, clear=True
+    )
+    def test_failures_are_damped(self):
+        # when less probes than tolerated fail in a row
+        damped_healthcheck("http", _failing_check)
+        damped_healthcheck("http", _failing_check)
+        damped_healthcheck("http", _succeeding_check)
+        damped_healthcheck("http", _failing_check)
+        damped_healthcheck("http", _failing_check)
+
+        # then healthcheck should fail only for the third failure in a row
+        with self.assertRaises(SystemExit):
+            damped_healthcheck("http", _failing_check)
+
+    # given 2 successes are required to recover
+    @patch.dict(
+        os.environ, {"TARGET": "localhost", "HEALTHCHECK_SUCCESSES": "2"}, clear=True
+    )
+    def test_recovery_hysteresis(self):
+        # when the probe failed before
+        self.assertEqual(record_probe("http", False, 2000), "unhealthy")
+
+        # then a single success should not be enough to be healthy again
+        self.assertEqual(record_probe("http", True, 10), "unhealthy")
+        self.assertEqual(record_probe("http", True, 10), "healthy")
+
+    # given a degraded threshold
+    @patch.dict(
+        os.environ,
+        {
+            "TARGET": "localhost",
+            "HEALTHCHECK_DEGRADED_MS": "100",
+            "HEALTHCHECK_EWMA_ALPHA": "0.5",
+        },
+        clear=True,
+    )
+    def test_degraded_latency(self):
+        # when the average latency rises above the threshold
+        self.assertEqual(record_probe("http", True, 50), "healthy")
+        self.assertEqual(record_probe("http", True, 130), "healthy")
+
+        # then it should be reported as degraded, not as unhealthy
+        self.assertEqual(record_probe("http", True, 210), "degraded")
+        # and a single fast probe should only lower the average
+        self.assertEqual(record_probe("http", True, 90), "degraded")
+        self.assertEqual(record_probe("http", True, 10), "healthy")
+
+    # given a small history
+    @patch.dict(
+        os.environ, {"TARGET": "localhost", "HEALTHCHECK_HISTORY_SIZE": "3"}, clear=True
+    )
+    def test_history_is_bounded(self):
+        import json
+
+        # when probing more often than the history holds
+        for latency in range(5):
+            record_probe("smtp", True, latency)
+
+        # then only the most recent results should be kept
+        with open(os.path.join(tempfile.gettempdir(), "healthcheck_smtp.json")) as fp:
+            results = json.load(fp)["results"]
+        self.assertEqual([result["latency_ms"] for result in results], [2, 3, 4])
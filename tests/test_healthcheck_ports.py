@@ -10,7 +10,7 @@ from healthcheck import http_healthcheck, smtp_healthcheck
 @patch("pycurl.Curl")
 class TestHealthcheckPorts(TestCase):
     # given default environment
-    @patch.dict(os.environ, {"PORT": "80 443"}, clear=True)
+    @patch.dict(os.environ, {"TARGET": "localhost", "PORT": "80 443"}, clear=True)
     def test_healthcheck_http_default_port(self, mock_curl):
         # when running http_healthcheck
         http_healthcheck()
@@ -21,13 +21,19 @@ class TestHealthcheckPorts(TestCase):
                 call().setopt(pycurl.URL, "http://localhost/"),
                 # and port 80 should be used
                 call().setopt(pycurl.RESOLVE, ["localhost:80:127.0.0.1"]),
+                # and the request should be sent from the probe address
+                call().setopt(pycurl.INTERFACE, "host!127.0.0.2"),
             ]
         )
 
     # given default environment with https url specified
     @patch.dict(
         os.environ,
-        {"PORT": "80 443", "HTTP_HEALTHCHECK_URL": "https://localhost/"},
+        {
+            "TARGET": "localhost",
+            "PORT": "80 443",
+            "HTTP_HEALTHCHECK_URL": "https://localhost/",
+        },
         clear=True,
     )
     def test_healthcheck_https_default_port(self, mock_curl):
@@ -44,7 +50,7 @@ class TestHealthcheckPorts(TestCase):
         )
 
     # given special http port
-    @patch.dict(os.environ, {"PORT": "8025"}, clear=True)
+    @patch.dict(os.environ, {"TARGET": "localhost", "PORT": "8025"}, clear=True)
     def test_healthcheck_http_custom_port(self, mock_curl):
         # when running http_healthcheck
         http_healthcheck()
@@ -59,7 +65,7 @@ class TestHealthcheckPorts(TestCase):
         )
 
     # given smtp environment
-    @patch.dict(os.environ, {"PORT": "25"}, clear=True)
+    @patch.dict(os.environ, {"TARGET": "localhost", "PORT": "25"}, clear=True)
     def test_healthcheck_smtp_default_port(self, mock_curl):
         # when running smtp_healthcheck
         smtp_healthcheck()
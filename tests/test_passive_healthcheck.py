@@ -0,0 +1,203 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+from unittest.mock import MagicMock, patch
+
+from helpers import RELAY_ADDRESS, TARGET_ADDRESS, TempDirTestCase, running_relay
+
+from config import PROBE_ADDRESS, compile_plan
+from healthcheck import damped_healthcheck
+from proxy import BufferPool, Relay
+
+
+class TestPassiveHealthcheck(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.check = MagicMock(__name__="check")
+
+    def _write_status(self, **status):
+        status = dict(
+            {
+                "ip": "192.0.2.1",
+                "circuit_breaker": "closed",
+                "last_success": time.time(),
+                "last_failure": None,
+                "consecutive_failures": 0,
+                "ttfb_ms": 42,
+            },
+            **status
+        )
+        with open(
+            os.path.join(tempfile.gettempdir(), "proxy_status_80.json"), "w"
+        ) as fp:
+            json.dump(status, fp)
+
+    def _history(self):
+        with open(os.path.join(tempfile.gettempdir(), "healthcheck_http.json")) as fp:
+            return json.load(fp)
+
+    # given passive health detection with the asyncio engine
+    @patch.dict(
+        os.environ,
+        {
+            "TARGET": "localhost",
+            "ENGINE": "asyncio",
+            "PASSIVE_HEALTHCHECK_IDLE_MS": "30000",
+        },
+        clear=True,
+    )
+    def test_recent_traffic_skips_active_probe(self):
+        # when real clients connected recently
+        self._write_status()
+
+        # then the active probe should be skipped
+        damped_healthcheck("http", self.check, "80")
+        self.check.assert_not_called()
+        # and the time to first byte of real traffic should be recorded as latency
+        self.assertEqual(self._history()["results"][-1]["latency_ms"], 42)
+
+    @patch.dict(
+        os.environ,
+        {
+            "TARGET": "localhost",
+            "ENGINE": "asyncio",
+            "PASSIVE_HEALTHCHECK_IDLE_MS": "30000",
+        },
+        clear=True,
+    )
+    def test_idle_port_uses_active_probe(self):
+        # when the last real client connected longer ago than the idle window
+        self._write_status(last_success=time.time() - 60)
+
+        # then the active probe should be used
+        damped_healthcheck("http", self.check, "80")
+        self.check.assert_called_once()
+
+    @patch.dict(
+        os.environ,
+        {
+            "TARGET": "localhost",
+            "ENGINE": "asyncio",
+            "PASSIVE_HEALTHCHECK_IDLE_MS": "30000",
+        },
+        clear=True,
+    )
+    def test_failing_traffic_uses_active_probe(self):
+        # when real clients failed to connect after the last success
+        self._write_status(last_failure=time.time(), consecutive_failures=1)
+
+        # then the active probe should be used
+        damped_healthcheck("http", self.check, "80")
+        self.check.assert_called_once()
+
+    # given default environment
+    @patch.dict(os.environ, {"TARGET": "localhost", "ENGINE": "asyncio"}, clear=True)
+    def test_disabled_by_default(self):
+        # when real clients connected recently
+        self._write_status()
+
+        # then the active probe should still be used
+        damped_healthcheck("http", self.check, "80")
+        self.check.assert_called_once()
+
+
+class TestRelayTraffic(TempDirTestCase):
+    def test_records_connects_and_ttfb(self):
+        plan = compile_plan(
+            {"TARGET": "localhost", "PORT": "80", "HEALTHCHECK_EWMA_ALPHA": "0.5"}
+        )
+
+        async def _traffic():
+            relay = Relay(plan, plan.ports[0], None, BufferPool())
+            relay.connected(False)
+            relay.connected(False)
+            failures = relay.status["consecutive_failures"]
+            relay.connected(True)
+            relay.first_byte(100)
+            relay.first_byte(50)
+            relay.save_handle.cancel()
+            return failures, relay.status
+
+        # given a relay forwarding real traffic
+        with patch("proxy.write_status"):
+            failures, status = asyncio.run(_traffic())
+
+        # then failed connects should be counted until a connect succeeds
+        self.assertEqual(failures, 2)
+        self.assertEqual(status["consecutive_failures"], 0)
+        self.assertIsNotNone(status["last_success"])
+        # and the time to first byte should be averaged
+        self.assertEqual(status["ttfb_ms"], 75)
+
+    @patch.dict(os.environ, {"TARGET": "localhost", "ENGINE": "asyncio"}, clear=True)
+    def test_ignores_healthcheck_probes(self):
+        async def _clients():
+            # nothing listens on the port of the target address, so every connect gets refused
+            async with running_relay() as (port, _):
+                for local_address in (RELAY_ADDRESS, PROBE_ADDRESS):
+                    reader, writer = await asyncio.open_connection(
+                        RELAY_ADDRESS, int(port), local_addr=(local_address, 0)
+                    )
+                    try:
+                        await reader.read()
+                    except ConnectionResetError:
+                        pass
+                    writer.close()
+
+        # given a relay on the loopback address, like a sidecar
+        with patch.object(Relay, "connected") as mock_connected, self.assertLogs(
+            level="ERROR"
+        ):
+            # when a client and a healthcheck probe connect
+            asyncio.run(_clients())
+
+        # then only the client should be recorded
+        mock_connected.assert_called_once_with(False)
+
+    async def _time_first_byte(self, handle_target, request_after=None):
+        async with running_relay() as (port, _):
+            target = await asyncio.start_server(
+                handle_target, TARGET_ADDRESS, int(port)
+            )
+            try:
+                reader, writer = await asyncio.open_connection(RELAY_ADDRESS, int(port))
+                if request_after is not None:
+                    await asyncio.sleep(request_after)
+                    writer.write(b"ping")
+                await reader.readexactly(4)
+                writer.close()
+            finally:
+                target.close()
+
+    def test_ttfb_starts_at_request(self):
+        async def _echo(reader, writer):
+            writer.write(await reader.readexactly(4))
+            await writer.drain()
+            writer.close()
+
+        # given a target answering requests of clients right away
+        with patch.object(Relay, "first_byte") as mock_first_byte:
+            # when a client waits before sending its request, like connection pools do
+            asyncio.run(self._time_first_byte(_echo, 0.3))
+
+        # then the time to first byte shouldn't include the wait
+        (ttfb_ms,), _ = mock_first_byte.call_args
+        self.assertLess(ttfb_ms, 200)
+
+    def test_ttfb_starts_at_connect_for_banners(self):
+        async def _banner(reader, writer):
+            await asyncio.sleep(0.3)
+            writer.write(b"220 ")
+            await writer.drain()
+            writer.close()
+
+        # given a target greeting clients before they send anything, like smtp
+        with patch.object(Relay, "first_byte") as mock_first_byte:
+            # when the client waits for the greeting
+            asyncio.run(self._time_first_byte(_banner))
+
+        # then the time to first byte should be timed from the connect
+        (ttfb_ms,), _ = mock_first_byte.call_args
+        self.assertGreaterEqual(ttfb_ms, 300)
@@ -0,0 +1,76 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from helpers import TempDirTestCase, free_port
+
+import proxy
+from config import load_plan
+
+
+class TestProxyStartup(TempDirTestCase):
+    def setUp(self):
+        # the proxy clears its state files on startup, leave the ones of the machine running the tests alone
+        super().setUp()
+        self.port = free_port()
+        self.resolved = threading.Event()
+
+    def _slow_resolve(self, target, nameservers):
+        # simulate a slow round trip to public nameservers
+        time.sleep(1)
+        self.resolved.set()
+        return "192.0.2.1"
+
+    @patch("asyncio.create_subprocess_exec", new_callable=AsyncMock)
+    def test_listening_before_target_is_resolved(self, mock_exec):
+        mock_exec.return_value = MagicMock(wait=AsyncMock())
+        # given the healthcheck history of a previous run
+        history_file = os.path.join(tempfile.gettempdir(), "healthcheck_http.json")
+        with open(history_file, "w") as fp:
+            fp.write("{}")
+        # and a proxy pre-resolving its target with slow nameservers
+        environ = {
+            "MODE": "tcp",
+            "PORT": self.port,
+            "TARGET": "target.example.com",
+            "PRE_RESOLVE": "1",
+            "NAMESERVERS": "127.0.0.1",
+            "VERBOSE": "0",
+        }
+        with patch.dict(os.environ, environ, clear=True), patch(
+            "proxy.resolve", side_effect=self._slow_resolve
+        ):
+            # when starting the proxy
+            start = time.monotonic()
+            thread = threading.Thread(target=proxy.main)
+            thread.start()
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", int(self.port))).close()
+                    break
+                except ConnectionRefusedError:
+                    time.sleep(0.01)
+            startup_time = time.monotonic() - start
+            resolved_at_startup = self.resolved.is_set()
+            thread.join()
+
+        # then the port should accept connections before resolving finished
+        self.assertFalse(resolved_at_startup)
+        self.assertLess(startup_time, 0.5)
+        # and socat should take over the already listening socket
+        command = mock_exec.call_args.args
+        self.assertTrue(command[1].startswith("accept-fd:"))
+        self.assertEqual(command[2], "tcp-connect:192.0.2.1:%s" % self.port)
+        # and the healthcheck history of the previous run should be cleared
+        self.assertFalse(os.path.exists(history_file))
+        # and the validated plan should be cached for healthcheck
+        self.assertTrue(
+            os.path.exists(os.path.join(tempfile.gettempdir(), "proxy_plan.json"))
+        )
+        with patch("config.compile_plan") as mock_compile_plan:
+            plan = load_plan(environ)
+        self.assertEqual(plan.ports[0].port, self.port)
+        mock_compile_plan.assert_not_called()
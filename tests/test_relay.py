@@ -0,0 +1,105 @@
+import asyncio
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from helpers import RELAY_ADDRESS, TARGET_ADDRESS, TempDirTestCase, running_relay
+
+import proxy
+from proxy import BufferPool, Connection, Endpoint
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class TestBufferPool(TestCase):
+    def test_reuses_released_buffers(self):
+        # given a pool
+        pool = BufferPool(sizes=(16, 64), max_free=1)
+
+        # when a buffer is released
+        buffer = pool.acquire(1)
+        pool.release(buffer)
+
+        # then it should be handed out again for its size class only
+        self.assertEqual(len(pool.acquire(0)), 16)
+        self.assertIs(pool.acquire(1), buffer)
+
+    def test_keeps_max_free_buffers(self):
+        # given a pool keeping a single free buffer per size class
+        pool = BufferPool(sizes=(16,), max_free=1)
+
+        # when releasing more buffers
+        pool.release(pool.acquire(0))
+        pool.release(bytearray(16))
+
+        # then the others should be left to the garbage collector
+        self.assertEqual(len(pool.free[16]), 1)
+
+
+class TestRelay(TempDirTestCase):
+    def test_connections_have_no_dict(self):
+        self.assertFalse(hasattr(Connection(None), "__dict__"))
+        self.assertFalse(hasattr(Endpoint(None), "__dict__"))
+
+    async def _echo(self, reader, writer):
+        while data := await reader.read(65536):
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    async def _relay_echo(self, payloads):
+        async with running_relay() as (port, pool):
+            upstream = await asyncio.start_server(self._echo, TARGET_ADDRESS, int(port))
+            try:
+                reader, writer = await asyncio.open_connection(RELAY_ADDRESS, int(port))
+                echoed = []
+                for payload in payloads:
+                    writer.write(payload)
+                    echoed.append(await reader.readexactly(len(payload)))
+                writer.write_eof()
+                self.assertEqual(await reader.read(), b"")
+                writer.close()
+                return echoed, pool
+            finally:
+                upstream.close()
+
+    def test_relays_data(self, event_loop="asyncio"):
+        payloads = [b"ping", bytes(range(256)) * 4096, b"pong"]
+
+        # when sending data through the relay to an echo server
+        loop = proxy.new_event_loop(event_loop)
+        try:
+            echoed, pool = loop.run_until_complete(self._relay_echo(payloads))
+        finally:
+            loop.close()
+
+        # then everything should come back unchanged
+        self.assertEqual(echoed, payloads)
+        # and the buffers should be returned to the pool
+        self.assertTrue(any(pool.free.values()))
+
+    @skipUnless(uvloop, "uvloop is not installed")
+    def test_relays_data_uvloop(self):
+        self.test_relays_data("uvloop")
+
+
+class TestEventLoop(TestCase):
+    @patch.dict("sys.modules", {"uvloop": None})
+    def test_falls_back_without_uvloop(self):
+        # given uvloop is selected but not installed
+        with self.assertLogs(level="WARNING") as logs:
+            # when creating the event loop
+            loop = proxy.new_event_loop("uvloop")
+        loop.close()
+
+        # then the asyncio event loop should be used
+        self.assertIsInstance(loop, asyncio.BaseEventLoop)
+        self.assertIn("uvloop is not installed", logs.output[0])
+
+    @skipUnless(uvloop, "uvloop is not installed")
+    def test_uses_uvloop(self):
+        loop = proxy.new_event_loop("uvloop")
+        loop.close()
+        self.assertIsInstance(loop, uvloop.Loop)